@@ -1,11 +1,18 @@
 import asyncio
 import sys
 
+import yaml
 from loguru import logger
 
 from .loadbalancer import LoadBalancer
 
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
 logger.remove()
 logger.add(
     sys.stderr,
@@ -18,8 +25,20 @@ def main():
         logger.error('Usage: aphrodite-loadbalancer <config.yaml>')
         sys.exit(1)
 
+    if not yaml.__with_libyaml__:
+        logger.warning(
+            'PyYAML was built without libyaml, falling back to the slower '
+            'pure-Python config parser'
+        )
+
     config_path = sys.argv[1]
-    asyncio.run(async_main(config_path))
+    if uvloop is None:
+        asyncio.run(async_main(config_path))
+    elif sys.version_info >= (3, 11):
+        uvloop.run(async_main(config_path))
+    else:
+        uvloop.install()
+        asyncio.run(async_main(config_path))
 
 
 async def async_main(config_path: str):
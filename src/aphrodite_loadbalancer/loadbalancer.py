@@ -1,18 +1,189 @@
 import asyncio
-import random
-from itertools import cycle
+import json
+import math
+import os
+from collections import deque
+from functools import reduce
+from typing import Sequence
 from typing import Set
+from typing import Tuple
 
 import aiohttp
 import yaml
 from aiohttp import web
 from loguru import logger
+from multidict import CIMultiDict
+from multidict import CIMultiDictProxy
+from yarl import URL
+
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+
+_CORS_HEADERS = CIMultiDictProxy(
+    CIMultiDict(
+        {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+        }
+    )
+)
+_PROBE_PATHS = ('/health', '/readyz')
+_STREAM_CHUNK_SIZE = 64 * 1024
+# Seconds a retired client session is kept open when there is no upstream
+# timeout to bound its in-flight requests
+_SESSION_DRAIN_TIMEOUT = 30
+# Per-connection headers that must not be forwarded to the endpoint. Host is
+# set by aiohttp from the target URL. Content-Length is kept, since the body
+# is relayed unchanged.
+_HOP_BY_HOP_HEADERS = frozenset(
+    {
+        'Host',
+        'Connection',
+        'Keep-Alive',
+        'Proxy-Authenticate',
+        'Proxy-Authorization',
+        'TE',
+        'Trailer',
+        'Transfer-Encoding',
+        'Upgrade',
+    }
+)
+
+
+def load_config(config_path: str) -> dict:
+    """Load the YAML config, using a JSON sidecar cache when it was built
+    from a config file with the exact same mtime and size"""
+    cache_path = config_path + '.cache.json'
+    with open(config_path, 'r') as f:
+        # Stamp the cache from the file as it was before parsing, so an edit
+        # made while the YAML is being read invalidates it
+        st = os.fstat(f.fileno())
+        stamp = [st.st_mtime_ns, st.st_size]
+        try:
+            with open(cache_path, 'r') as cache:
+                cached = json.load(cache)
+            if cached['stamp'] == stamp:
+                return cached['config']
+        except (OSError, ValueError, TypeError, KeyError):
+            pass
+
+        config = yaml.load(f, Loader=_YamlLoader)
+
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'stamp': stamp, 'config': config}, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug(f'Not caching config to {cache_path}: {e}')
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    return config
+
+
+class RoundRobinScheduler:
+    """Plain round-robin over endpoint indices, used when all weights are
+    equal. Every pick is O(1) and the state is a single counter.
+    """
+
+    __slots__ = ('_indices', '_size', '_counter')
+
+    def __init__(self, indices: Sequence[int]):
+        if not indices:
+            raise ValueError('At least one index is required')
+        self._indices = indices
+        self._size = len(indices)
+        self._counter = -1
+
+    def pick(self) -> int:
+        self._counter = counter = (self._counter + 1) % self._size
+        return self._indices[counter]
+
+
+class IWRRScheduler:
+    """Interleaved weighted round-robin over endpoint indices.
+
+    Every pick is O(1) and the state is O(n) in the number of endpoints,
+    regardless of how large the weights are. Picks of heavier endpoints are
+    interleaved with the others instead of being emitted in bursts.
+    """
+
+    __slots__ = ('_current', '_next')
+
+    def __init__(self, nodes: Sequence[Tuple[int, int]]):
+        """`nodes` is a sequence of (endpoint index, weight) pairs"""
+        nodes = [(index, weight) for index, weight in nodes if weight > 0]
+        if not nodes:
+            raise ValueError('At least one node needs a positive weight')
+        divisor = reduce(math.gcd, (weight for _, weight in nodes))
+        # [index, weight, remainder]
+        self._current = deque(
+            [index, weight // divisor, weight // divisor]
+            for index, weight in nodes
+        )
+        self._next = deque()
+
+    def pick(self) -> int:
+        if not self._current:
+            self._current, self._next = self._next, self._current
+        node = self._current.popleft()
+        node[2] -= 1
+        if node[2] > 0:
+            self._current.append(node)
+        else:
+            node[2] = node[1]
+            self._next.append(node)
+        return node[0]
+
+
+class SmoothWRRScheduler:
+    """Smooth weighted round-robin over endpoint indices, as used by Nginx.
+
+    Every pick is O(n) in the number of endpoints and spreads the picks of
+    heavier endpoints as evenly as possible, e.g. weights 5, 1, 1 give
+    a a b a c a a.
+    """
+
+    __slots__ = ('_indices', '_weights', '_current', '_total')
+
+    def __init__(self, nodes: Sequence[Tuple[int, int]]):
+        """`nodes` is a sequence of (endpoint index, weight) pairs"""
+        nodes = [(index, weight) for index, weight in nodes if weight > 0]
+        if not nodes:
+            raise ValueError('At least one node needs a positive weight')
+        self._indices = [index for index, _ in nodes]
+        self._weights = [weight for _, weight in nodes]
+        self._current = [0] * len(nodes)
+        self._total = sum(self._weights)
+
+    def pick(self) -> int:
+        current = self._current
+        best = 0
+        for i, weight in enumerate(self._weights):
+            current[i] += weight
+            if current[i] > current[best]:
+                best = i
+        current[best] -= self._total
+        return self._indices[best]
+
+
+_SCHEDULERS = {
+    'iwrr': IWRRScheduler,
+    'smooth': SmoothWRRScheduler,
+}
 
 
 class LoadBalancer:
     def __init__(self, config_path: str):
-        with open(config_path, 'r') as f:
-            config = yaml.safe_load(f)
+        config = load_config(config_path)
 
         self.endpoints = []
         self.weights = []
@@ -29,6 +200,17 @@ class LoadBalancer:
                 self.endpoints.append(endpoint)
                 self.weights.append(1)
 
+        self._endpoint_bases = [e.rstrip('/') for e in self.endpoints]
+        self._inflight = [0] * len(self.endpoints)
+        self.least_connections = config.get('least_connections', False)
+
+        self.scheduler = config.get('scheduler', 'iwrr')
+        if self.scheduler not in _SCHEDULERS:
+            raise ValueError(
+                f'Unknown scheduler {self.scheduler!r}, expected one of '
+                f'{", ".join(_SCHEDULERS)}'
+            )
+
         self.port = config.get('port', 8080)
         self.request_count = 0
         self.client_session = None
@@ -36,6 +218,26 @@ class LoadBalancer:
         self.health_check_interval = config.get('health_check_interval', 30)
         self.unhealthy_endpoints: Set[int] = set()
         self.health_check_timeout = config.get('health_check_timeout', 2)
+        self._health_check_timeout = aiohttp.ClientTimeout(
+            total=self.health_check_timeout
+        )
+        # Bumped on every health flap; schedulers are rebuilt lazily on the
+        # next pick instead of once per flap
+        self._health_generation = 0
+
+        self.connection_limit = config.get('connection_limit', 0)
+        self.connection_limit_per_host = config.get(
+            'connection_limit_per_host', 256
+        )
+        self.keepalive_timeout = config.get('keepalive_timeout', 75)
+        self.dns_cache_ttl = config.get('dns_cache_ttl', 300)
+        self.session_max_age = config.get('session_max_age', 600)
+        self.upstream_timeout = config.get('upstream_timeout', 30)
+        self._upstream_timeout = aiohttp.ClientTimeout(
+            total=self.upstream_timeout, connect=5
+        )
+        # Tasks closing sessions retired by recycle_session
+        self._draining_sessions: Set[asyncio.Task] = set()
 
         self._create_weighted_cycles()
 
@@ -43,7 +245,7 @@ class LoadBalancer:
         try:
             assert self.client_session is not None
             async with self.client_session.get(
-                f'{endpoint}/health', timeout=self.health_check_timeout
+                f'{endpoint}/health', timeout=self._health_check_timeout
             ) as resp:
                 return resp.status == 200
         except Exception:
@@ -52,116 +254,258 @@ class LoadBalancer:
     async def monitor_health(self):
         """Continuously monitor endpoint health"""
         while True:
-            for i, endpoint in enumerate(self.endpoints):
+            results = await asyncio.gather(
+                *(self.health_check(base) for base in self._endpoint_bases),
+                return_exceptions=True,
+            )
+
+            changed = False
+            for i, (endpoint, result) in enumerate(
+                zip(self.endpoints, results)
+            ):
+                # Exceptions from the probe count as unhealthy
+                is_healthy = result is True
                 was_healthy = i not in self.unhealthy_endpoints
-                is_healthy = await self.health_check(endpoint)
 
                 if not is_healthy and was_healthy:
                     logger.warning(f'Endpoint {endpoint} is down')
                     self.unhealthy_endpoints.add(i)
-                    self._create_weighted_cycles()
+                    changed = True
                 elif is_healthy and not was_healthy:
                     logger.info(f'Endpoint {endpoint} is back up')
                     self.unhealthy_endpoints.remove(i)
-                    self._create_weighted_cycles()
+                    changed = True
+
+            if changed:
+                self._health_generation += 1
 
             await asyncio.sleep(self.health_check_interval)
 
     def _create_weighted_cycles(self):
-        """Create weighted index cycles for load balancing, excluding unhealthy
+        """Create weighted schedulers for load balancing, excluding unhealthy
         endpoints"""
-        weighted_indices = []
-        for i, weight in enumerate(self.weights):
-            if i not in self.unhealthy_endpoints:
-                weighted_indices.extend([i] * weight)
+        self._cycles_generation = self._health_generation
+        self._healthy = [
+            i
+            for i, weight in enumerate(self.weights)
+            if i not in self.unhealthy_endpoints and weight > 0
+        ]
 
-        if not weighted_indices:
+        if not self._healthy:
             logger.critical('All endpoints are unhealthy!')
-            weighted_indices = list(range(len(self.endpoints)))
+            self._healthy = list(range(len(self.endpoints)))
+            weights = {1}
+        else:
+            weights = {self.weights[i] for i in self._healthy}
+
+        # Every weighted scheduler degrades to plain round-robin when the
+        # weights are equal, so skip their bookkeeping in that case
+        if len(weights) == 1:
+            self.completion_cycle = RoundRobinScheduler(self._healthy)
+            self.general_cycle = RoundRobinScheduler(self._healthy)
+        else:
+            nodes = [(i, self.weights[i]) for i in self._healthy]
+            scheduler_cls = _SCHEDULERS[self.scheduler]
+            self.completion_cycle = scheduler_cls(nodes)
+            self.general_cycle = scheduler_cls(nodes)
+
+    def _create_client_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            limit_per_host=self.connection_limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        return aiohttp.ClientSession(connector=connector)
 
-        random.shuffle(weighted_indices)
+    async def recycle_session(self):
+        """Periodically replace the client session, so that long-lived
+        upstream connections don't get silently reset by intermediaries"""
+        drain = self.upstream_timeout
+        if drain is None:
+            # Requests never time out, so there is no bound to wait for
+            drain = _SESSION_DRAIN_TIMEOUT
+        while True:
+            await asyncio.sleep(self.session_max_age)
+            retired_session = self.client_session
+            self.client_session = self._create_client_session()
+            logger.debug('Recycled upstream client session')
+            if retired_session:
+                # Closed in the background, so the swap cadence stays at
+                # session_max_age
+                task = asyncio.create_task(
+                    self._close_later(retired_session, drain)
+                )
+                self._draining_sessions.add(task)
+                task.add_done_callback(self._draining_sessions.discard)
 
-        self.completion_cycle = cycle(weighted_indices.copy())
-        self.general_cycle = cycle(weighted_indices.copy())
+    async def _close_later(self, session: aiohttp.ClientSession, delay):
+        """Close a retired session once in-flight requests on it have had
+        `delay` seconds to finish"""
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            await session.close()
+
+    def _add_routes(self, app: web.Application):
+        # aiohttp's router picks the handler, so no path comparison is needed
+        # in Python. Plain paths are matched before the catch-all, and each
+        # resource tries its routes in order, so OPTIONS goes first.
+        for path in _PROBE_PATHS:
+            app.router.add_route('*', path, self.handle_probe)
+        for path, handler in (
+            ('/v1/completions', self.handle_completions),
+            ('/{tail:.*}', self.handle_request),
+        ):
+            app.router.add_route('OPTIONS', path, self.handle_options)
+            app.router.add_route('*', path, handler)
 
     async def start(self, port: int):
-        self.client_session = aiohttp.ClientSession()
+        """Start serving on `port`. Pass 0 to bind any free port, which is
+        then available as `self.port`"""
+        self.client_session = self._create_client_session()
         app = web.Application()
-        app.router.add_route('*', '/{tail:.*}', self.handle_request)
+        self._add_routes(app)
 
         self._health_monitor_task = asyncio.create_task(self.monitor_health())
+        if self.session_max_age:
+            self._session_recycle_task = asyncio.create_task(
+                self.recycle_session()
+            )
 
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', port)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '0.0.0.0', port)
         await site.start()
-        logger.info(f'Load balancer running on http://0.0.0.0:{port}')
+        self.port = self._runner.addresses[0][1]
+        logger.info(f'Load balancer running on http://0.0.0.0:{self.port}')
 
         for i, (endpoint, weight) in enumerate(
             zip(self.endpoints, self.weights)
         ):
             logger.info(f'Endpoint {i}: {endpoint} (weight: {weight})')
 
+    async def handle_probe(self, request: web.Request) -> web.Response:
+        """Answer liveness/readiness probes locally instead of proxying
+        them to an endpoint"""
+        if request.method in ('GET', 'HEAD'):
+            return web.Response(body=b'OK', headers=_CORS_HEADERS)
+        if request.method == 'OPTIONS':
+            return web.Response(headers=_CORS_HEADERS)
+        return web.Response(status=405, headers={'Allow': 'GET, HEAD'})
+
+    async def handle_options(self, request: web.Request) -> web.Response:
+        return web.Response(headers=_CORS_HEADERS)
+
+    async def handle_completions(
+        self, request: web.Request
+    ) -> web.StreamResponse:
+        return await self._proxy(request, completions=True)
+
     async def handle_request(self, request: web.Request) -> web.StreamResponse:
-        cors_headers = {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-        }
+        return await self._proxy(request, completions=False)
 
-        if request.method == 'OPTIONS':
-            return web.Response(headers=cors_headers)
+    async def _proxy(
+        self, request: web.Request, completions: bool
+    ) -> web.StreamResponse:
+        if self._cycles_generation != self._health_generation:
+            self._create_weighted_cycles()
 
-        if request.path in self.path_routes:
-            endpoint_index = self.path_routes[request.path]
-            if endpoint_index in self.unhealthy_endpoints:
-                endpoint_index = next(self.general_cycle)
-        else:
-            if request.path == '/v1/completions':
-                endpoint_index = next(self.completion_cycle)
-            else:
-                endpoint_index = next(self.general_cycle)
-        target_url = self.endpoints[endpoint_index]
-
-        path = request.path
-        if request.query_string:
-            path += f'?{request.query_string}'
-        target_url = f"{target_url.rstrip('/')}/{path.lstrip('/')}"
-        
-        logger.info(
-            f"Routing {request.method} {path} to endpoint "
-            f"{endpoint_index}: {target_url}")
+        endpoint_index = self.path_routes.get(request.path)
+        if endpoint_index is None or endpoint_index in self.unhealthy_endpoints:
+            scheduler = (
+                self.completion_cycle if completions else self.general_cycle
+            )
+            endpoint_index = scheduler.pick()
+            # Power of two choices: only when the scheduled endpoint is busy,
+            # draw a second one and keep whichever has fewer requests in flight
+            if self.least_connections and self._inflight[endpoint_index]:
+                candidate = scheduler.pick()
+                if self._inflight[candidate] < self._inflight[endpoint_index]:
+                    endpoint_index = candidate
+
+        path = request.rel_url.raw_path_qs
+        # The path is already percent-encoded, so skip yarl's requoting.
+        # URL.join() is not used because it drops any path prefix of the base.
+        target_url = URL(
+            f'{self._endpoint_bases[endpoint_index]}{path}', encoded=True
+        )
+
+        # Formatting is deferred to loguru, so it is skipped when the level
+        # is disabled
+        logger.debug(
+            'Routing {} {} to endpoint {}: {}',
+            request.method,
+            path,
+            endpoint_index,
+            target_url,
+        )
 
+        forward_headers = request.headers.copy()
+        for name in _HOP_BY_HOP_HEADERS:
+            forward_headers.popall(name, None)
+
+        # The body is relayed in bounded chunks as the endpoint consumes it.
+        # Requests without one are sent without a body, rather than with an
+        # empty chunked payload
+        body = None
+        if request.body_exists:
+            body = request.content.iter_chunked(_STREAM_CHUNK_SIZE)
+
+        self._inflight[endpoint_index] += 1
         try:
             assert self.client_session is not None
             async with self.client_session.request(
                 method=request.method,
                 url=target_url,
-                headers=request.headers,
-                data=request.content,
+                headers=forward_headers,
+                data=body,
                 allow_redirects=False,
-                timeout=aiohttp.ClientTimeout(total=30),
+                timeout=self._upstream_timeout,
             ) as resp:
+                headers = CIMultiDict(resp.headers)
+                headers.update(_CORS_HEADERS)
                 response = web.StreamResponse(
-                    status=resp.status, headers={**resp.headers, **cors_headers}
+                    status=resp.status, headers=headers
                 )
                 await response.prepare(request)
 
-                async for chunk in resp.content.iter_any():
+                # Chunks are forwarded as soon as they arrive, capped in size;
+                # aiohttp only drains the transport past its write buffer limit
+                async for chunk in resp.content.iter_chunked(
+                    _STREAM_CHUNK_SIZE
+                ):
                     await response.write(chunk)
 
                 await response.write_eof()
                 return response
 
-        except Exception as e:
-            logger.error(f'Request failed: {str(e)}')
+        except Exception:
+            logger.exception('Request to {} failed', target_url)
             raise
+        finally:
+            self._inflight[endpoint_index] -= 1
 
     async def cleanup(self):
-        if hasattr(self, '_health_monitor_task'):
-            self._health_monitor_task.cancel()
+        for task_name in ('_health_monitor_task', '_session_recycle_task'):
+            task = getattr(self, task_name, None)
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        if getattr(self, '_runner', None) is not None:
+            await self._runner.cleanup()
+
+        # Cancelling skips the drain, closing the retired sessions right away
+        for task in list(self._draining_sessions):
+            task.cancel()
             try:
-                await self._health_monitor_task
+                await task
             except asyncio.CancelledError:
                 pass
 
@@ -0,0 +1,26 @@
+import asyncio
+
+import aiohttp
+import pytest_asyncio
+
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Run the suite on uvloop when it is available, like the CLI does
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+@pytest_asyncio.fixture(scope='session', loop_scope='session')
+async def http_session():
+    """Client session shared by all tests, so connections and the DNS cache
+    are reused instead of being set up for every test. The pool is unbounded
+    so concurrent bursts never queue in the connector."""
+    connector = aiohttp.TCPConnector(
+        limit=0, limit_per_host=0, force_close=False, ttl_dns_cache=300
+    )
+    async with aiohttp.ClientSession(connector=connector) as session:
+        yield session
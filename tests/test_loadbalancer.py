@@ -1,27 +1,51 @@
 import asyncio
-import socket
+import contextlib
+import json
+import os
 import tempfile
-from itertools import cycle
 
-import aiohttp
 import pytest
 import pytest_asyncio
 import yaml
 from aiohttp import web
+from loguru import logger
 
+from aphrodite_loadbalancer.loadbalancer import _CORS_HEADERS
+from aphrodite_loadbalancer.loadbalancer import IWRRScheduler
 from aphrodite_loadbalancer.loadbalancer import LoadBalancer
+from aphrodite_loadbalancer.loadbalancer import SmoothWRRScheduler
+from aphrodite_loadbalancer.loadbalancer import load_config
 
 
-def create_test_config(endpoints):
-    config = {'endpoints': endpoints}
+try:
+    from yaml import CSafeDumper as _YamlDumper
+except ImportError:
+    _YamlDumper = None
+
+
+def create_test_config(endpoints, **options):
+    config = {'endpoints': endpoints, **options}
     with tempfile.NamedTemporaryFile(
         mode='w', delete=False, suffix='.yaml'
     ) as f:
-        yaml.dump(config, f)
+        if _YamlDumper is None:
+            # JSON is valid YAML, and much faster than the pure-Python dumper
+            json.dump(config, f)
+        else:
+            yaml.dump(config, f, Dumper=_YamlDumper)
         return f.name
 
 
 class DummyEndpoint:
+    __slots__ = (
+        'name',
+        'weight',
+        'request_count',
+        'last_request',
+        'should_fail',
+        'is_healthy',
+    )
+
     def __init__(self, name, weight=1):
         self.name = name
         self.weight = weight
@@ -42,157 +66,144 @@ class MockLoadBalancer(LoadBalancer):
         self.unhealthy_endpoints = set()
         self.health_check_interval = 1
         self.health_check_timeout = 1
+        self._health_generation = 0
+        self.connection_limit = 0
+        self.connection_limit_per_host = 256
+        self.keepalive_timeout = 75
+        self.dns_cache_ttl = 300
+        self._endpoint_bases = self.endpoints
+        self.session_max_age = 0
+        self._draining_sessions = set()
         self._create_weighted_cycles()
 
     def _create_weighted_cycles(self):
         """Create weighted index cycles for load balancing, excluding unhealthy
         endpoints"""
-        weighted_indices = []
-        for i, weight in enumerate(self.weights[:2]):
-            if i not in self.unhealthy_endpoints:
-                weighted_indices.extend([i] * weight)
+        self._cycles_generation = self._health_generation
+        nodes = [
+            (i, weight)
+            for i, weight in enumerate(self.weights[:2])
+            if i not in self.unhealthy_endpoints
+        ]
 
-        if not weighted_indices:
-            print('WARNING: All endpoints are unhealthy!')
-            weighted_indices = list(range(min(2, len(self.endpoints))))
+        if not nodes:
+            logger.critical('All endpoints are unhealthy!')
+            nodes = [(i, 1) for i in range(min(2, len(self.endpoints)))]
 
-        self.completion_cycle = cycle(weighted_indices)
-        self.general_cycle = cycle(weighted_indices)
+        self.completion_cycle = SmoothWRRScheduler(nodes)
+        self.general_cycle = SmoothWRRScheduler(nodes)
+        self._path_cycles = {'/v1/completions': self.completion_cycle}
 
     async def handle_request(self, request: web.Request) -> web.StreamResponse:
-        cors_headers = {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-        }
-
-        if request.method == 'OPTIONS':
-            return web.Response(headers=cors_headers)
+        if self._cycles_generation != self._health_generation:
+            self._create_weighted_cycles()
 
-        if request.path in self.path_routes:
-            endpoint_index = self.path_routes[request.path]
-            if endpoint_index in self.unhealthy_endpoints:
-                endpoint_index = next(self.general_cycle)
-        else:
-            if request.path == '/v1/completions':
-                endpoint_index = next(self.completion_cycle)
-            else:
-                endpoint_index = next(self.general_cycle)
+        endpoint_index = self.path_routes.get(request.path)
+        if endpoint_index is None or endpoint_index in self.unhealthy_endpoints:
+            scheduler = self._path_cycles.get(request.path, self.general_cycle)
+            endpoint_index = scheduler.pick()
 
         endpoint = self.dummy_endpoints[endpoint_index]
         endpoint.request_count += 1
-        endpoint.last_request = {
-            'method': request.method,
-            'path': request.path,
-            'query': request.query_string,
-        }
+        endpoint.last_request = (
+            request.method,
+            request.path,
+            request.query_string,
+        )
 
         if endpoint.should_fail:
             return web.Response(
-                status=500, text='Simulated failure', headers=cors_headers
+                status=500, text='Simulated failure', headers=_CORS_HEADERS
             )
 
         return web.Response(
-            text=f'Response from {endpoint.name}', headers=cors_headers
+            text=f'Response from {endpoint.name}', headers=_CORS_HEADERS
         )
 
+    handle_completions = handle_request
+
     async def health_check(self, endpoint: str) -> bool:
         index = self.endpoints.index(endpoint)
         return self.dummy_endpoints[index].is_healthy
 
 
-def get_free_port():
-    """Get a free port on the machine"""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))
-        s.listen(1)
-        port = s.getsockname()[1]
-    return port
-
-
 @pytest_asyncio.fixture
 async def load_balancer():
-    port = get_free_port()
     dummy_endpoints = [
         DummyEndpoint('endpoint1', weight=1),
         DummyEndpoint('endpoint2', weight=1),
         DummyEndpoint('endpoint3', weight=1),
     ]
     lb = MockLoadBalancer(dummy_endpoints)
-    await lb.start(port)
+    await lb.start(0)
     try:
-        yield lb, dummy_endpoints, port
+        yield lb, dummy_endpoints, lb.port
     finally:
         await lb.cleanup()
 
 
-@pytest.mark.asyncio
-async def test_round_robin_distribution(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_round_robin_distribution(load_balancer, http_session):
     lb, endpoints, port = load_balancer
-    async with aiohttp.ClientSession() as session:
-        for i in range(4):
-            async with session.get(
-                f'http://localhost:{port}/v1/models'
-            ) as resp:
-                assert resp.status == 200
+    for i in range(4):
+        async with http_session.get(
+            f'http://localhost:{port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
 
-        assert endpoints[0].request_count == 2
-        assert endpoints[1].request_count == 2
+    assert endpoints[0].request_count == 2
+    assert endpoints[1].request_count == 2
 
 
-@pytest.mark.asyncio
-async def test_separate_completion_routing(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_separate_completion_routing(load_balancer, http_session):
     lb, endpoints, port = load_balancer
-    async with aiohttp.ClientSession() as session:
-        for i in range(2):
-            async with session.post(
-                f'http://localhost:{port}/v1/completions'
-            ) as resp:
-                assert resp.status == 200
+    for i in range(2):
+        async with http_session.post(
+            f'http://localhost:{port}/v1/completions'
+        ) as resp:
+            assert resp.status == 200
 
-        for i in range(2):
-            async with session.get(
-                f'http://localhost:{port}/v1/models'
-            ) as resp:
-                assert resp.status == 200
+    for i in range(2):
+        async with http_session.get(
+            f'http://localhost:{port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
 
-        assert endpoints[0].request_count == 2
-        assert endpoints[1].request_count == 2
+    assert endpoints[0].request_count == 2
+    assert endpoints[1].request_count == 2
 
 
-@pytest.mark.asyncio
-async def test_cors_headers(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_cors_headers(load_balancer, http_session):
     lb, endpoints, port = load_balancer
-    async with aiohttp.ClientSession() as session:
-        async with session.options(
-            f'http://localhost:{port}/v1/models'
-        ) as resp:
-            assert resp.status == 200
-            assert 'Access-Control-Allow-Origin' in resp.headers
-            assert resp.headers['Access-Control-Allow-Origin'] == '*'
+    async with http_session.options(
+        f'http://localhost:{port}/v1/models'
+    ) as resp:
+        assert resp.status == 200
+        assert 'Access-Control-Allow-Origin' in resp.headers
+        assert resp.headers['Access-Control-Allow-Origin'] == '*'
 
 
-@pytest.mark.asyncio
-async def test_query_params_forwarding(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_query_params_forwarding(load_balancer, http_session):
     lb, endpoints, port = load_balancer
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f'http://localhost:{port}/v1/models?version=1'
-        ) as resp:
-            assert resp.status == 200
+    async with http_session.get(
+        f'http://localhost:{port}/v1/models?version=1'
+    ) as resp:
+        assert resp.status == 200
 
 
-@pytest.mark.asyncio
-async def test_error_handling(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_error_handling(load_balancer, http_session):
     lb, endpoints, port = load_balancer
-    async with aiohttp.ClientSession() as session:
-        endpoints[0].should_fail = True
-        async with session.get(f'http://localhost:{port}/v1/models') as resp:
-            assert resp.status == 500
+    endpoints[0].should_fail = True
+    async with http_session.get(f'http://localhost:{port}/v1/models') as resp:
+        assert resp.status == 500
 
 
-@pytest.mark.asyncio
-async def test_weighted_distribution(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_weighted_distribution(load_balancer, http_session):
     lb, endpoints, port = load_balancer
 
     endpoints[0].weight = 2
@@ -200,40 +211,38 @@ async def test_weighted_distribution(load_balancer):
     lb.weights = [endpoint.weight for endpoint in endpoints]
     lb._create_weighted_cycles()
 
-    async with aiohttp.ClientSession() as session:
-        num_requests = 100
-        for _ in range(num_requests):
-            async with session.get(
-                f'http://localhost:{port}/v1/models'
-            ) as resp:
-                assert resp.status == 200
-
-        total_requests = endpoints[0].request_count + endpoints[1].request_count
-        weight_ratio = endpoints[0].weight / (
-            endpoints[0].weight + endpoints[1].weight
-        )
-        actual_ratio = endpoints[0].request_count / total_requests
+    num_requests = 100
+    for _ in range(num_requests):
+        async with http_session.get(
+            f'http://localhost:{port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
 
-        assert (
-            abs(actual_ratio - weight_ratio) < 0.1
-        ), f'Expected ratio around {weight_ratio}, got {actual_ratio}'
+    total_requests = endpoints[0].request_count + endpoints[1].request_count
+    weight_ratio = endpoints[0].weight / (
+        endpoints[0].weight + endpoints[1].weight
+    )
+    actual_ratio = endpoints[0].request_count / total_requests
 
+    assert (
+        abs(actual_ratio - weight_ratio) < 0.1
+    ), f'Expected ratio around {weight_ratio}, got {actual_ratio}'
 
-@pytest.mark.asyncio
-async def test_health_check_unhealthy_endpoint(load_balancer):
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_health_check_unhealthy_endpoint(load_balancer, http_session):
     lb, endpoints, port = load_balancer
 
     endpoints[0].is_healthy = False
 
     await asyncio.sleep(2)
 
-    async with aiohttp.ClientSession() as session:
-        for _ in range(5):
-            async with session.get(
-                f'http://localhost:{port}/v1/models'
-            ) as resp:
-                assert resp.status == 200
-                await resp.text()
+    for _ in range(5):
+        async with http_session.get(
+            f'http://localhost:{port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
+            await resp.text()
 
     assert (
         endpoints[0].request_count == 0
@@ -243,20 +252,19 @@ async def test_health_check_unhealthy_endpoint(load_balancer):
     ), 'All requests should go to healthy endpoint'
 
 
-@pytest.mark.asyncio
-async def test_health_check_recovery(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_health_check_recovery(load_balancer, http_session):
     lb, endpoints, port = load_balancer
 
     endpoints[0].is_healthy = False
     await asyncio.sleep(2)
 
-    async with aiohttp.ClientSession() as session:
-        for _ in range(3):
-            async with session.get(
-                f'http://localhost:{port}/v1/models'
-            ) as resp:
-                assert resp.status == 200
-                await resp.text()
+    for _ in range(3):
+        async with http_session.get(
+            f'http://localhost:{port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
+            await resp.text()
 
     endpoints[0].is_healthy = True
     await asyncio.sleep(2)
@@ -264,13 +272,12 @@ async def test_health_check_recovery(load_balancer):
     endpoints[0].request_count = 0
     endpoints[1].request_count = 0
 
-    async with aiohttp.ClientSession() as session:
-        for _ in range(4):
-            async with session.get(
-                f'http://localhost:{port}/v1/models'
-            ) as resp:
-                assert resp.status == 200
-                await resp.text()
+    for _ in range(4):
+        async with http_session.get(
+            f'http://localhost:{port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
+            await resp.text()
 
     assert (
         endpoints[0].request_count > 0
@@ -280,8 +287,8 @@ async def test_health_check_recovery(load_balancer):
     ), 'Previously healthy endpoint should still receive requests'
 
 
-@pytest.mark.asyncio
-async def test_all_endpoints_unhealthy(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_all_endpoints_unhealthy(load_balancer, http_session):
     lb, endpoints, port = load_balancer
 
     for endpoint in endpoints:
@@ -289,10 +296,9 @@ async def test_all_endpoints_unhealthy(load_balancer):
 
     await asyncio.sleep(2)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'http://localhost:{port}/v1/models') as resp:
-            assert resp.status == 200
-            await resp.text()
+    async with http_session.get(f'http://localhost:{port}/v1/models') as resp:
+        assert resp.status == 200
+        await resp.text()
 
     total_requests = sum(endpoint.request_count for endpoint in endpoints)
     assert (
@@ -300,23 +306,24 @@ async def test_all_endpoints_unhealthy(load_balancer):
     ), 'Requests should be processed even when all endpoints are unhealthy'
 
 
-@pytest.mark.asyncio
-async def test_path_specific_routing(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_path_specific_routing(load_balancer, http_session):
     lb, endpoints, port = load_balancer
 
     lb.path_routes = {'/v1/tokenize': 2, '/v1/detokenize': 2}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f'http://localhost:{port}/v1/tokenize') as resp:
-            assert resp.status == 200
+    async with http_session.post(
+        f'http://localhost:{port}/v1/tokenize'
+    ) as resp:
+        assert resp.status == 200
 
-        async with session.post(
-            f'http://localhost:{port}/v1/detokenize'
-        ) as resp:
-            assert resp.status == 200
+    async with http_session.post(
+        f'http://localhost:{port}/v1/detokenize'
+    ) as resp:
+        assert resp.status == 200
 
-        async with session.get(f'http://localhost:{port}/v1/models') as resp:
-            assert resp.status == 200
+    async with http_session.get(f'http://localhost:{port}/v1/models') as resp:
+        assert resp.status == 200
 
     assert (
         endpoints[2].request_count == 2
@@ -326,8 +333,10 @@ async def test_path_specific_routing(load_balancer):
     ), 'Regular requests should use normal distribution'
 
 
-@pytest.mark.asyncio
-async def test_path_routing_with_unhealthy_endpoint(load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_path_routing_with_unhealthy_endpoint(
+    load_balancer, http_session
+):
     lb, endpoints, port = load_balancer
 
     lb.path_routes = {'/v1/tokenize': 2, '/v1/detokenize': 2}
@@ -335,9 +344,10 @@ async def test_path_routing_with_unhealthy_endpoint(load_balancer):
     endpoints[2].is_healthy = False
     await asyncio.sleep(2)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f'http://localhost:{port}/v1/tokenize') as resp:
-            assert resp.status == 200
+    async with http_session.post(
+        f'http://localhost:{port}/v1/tokenize'
+    ) as resp:
+        assert resp.status == 200
 
     assert (
         endpoints[2].request_count == 0
@@ -345,3 +355,339 @@ async def test_path_routing_with_unhealthy_endpoint(load_balancer):
     assert (
         endpoints[0].request_count + endpoints[1].request_count == 1
     ), 'Requests should fall back to healthy endpoints'
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_health_probe_not_proxied(load_balancer, http_session):
+    lb, endpoints, port = load_balancer
+
+    for path in ('/health', '/readyz'):
+        async with http_session.get(f'http://localhost:{port}{path}') as resp:
+            assert resp.status == 200
+            assert await resp.text() == 'OK'
+
+    async with http_session.post(f'http://localhost:{port}/health') as resp:
+        assert resp.status == 405
+        assert resp.headers['Allow'] == 'GET, HEAD'
+
+    assert (
+        sum(endpoint.request_count for endpoint in endpoints) == 0
+    ), 'Health probes should be answered by the load balancer itself'
+
+
+async def _wait_for(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, 'Timed out'
+        await asyncio.sleep(0.01)
+
+
+@contextlib.asynccontextmanager
+async def real_load_balancer(
+    handlers, base_path='', probes=None, **options
+):
+    """Run a real LoadBalancer in front of one upstream per handler. Each
+    upstream is configured with `base_path` appended to its URL, answers
+    health checks under it, and sends every other request to its handler.
+    The paths of the health checks are appended to `probes` if given."""
+
+    async def health(request):
+        if probes is not None:
+            probes.append(request.raw_path)
+        return web.Response(text='OK')
+
+    runners = []
+    config_path = None
+    lb = None
+    try:
+        endpoints = []
+        for handler in handlers:
+            app = web.Application()
+            app.router.add_get(base_path.rstrip('/') + '/health', health)
+            app.router.add_route('*', '/{tail:.*}', handler)
+            runner = web.AppRunner(app)
+            runners.append(runner)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', 0).start()
+            endpoints.append(
+                f'http://127.0.0.1:{runner.addresses[0][1]}{base_path}'
+            )
+
+        config_path = create_test_config(endpoints, **options)
+        lb = LoadBalancer(config_path)
+        await lb.start(0)
+        yield lb
+    finally:
+        if lb is not None:
+            await lb.cleanup()
+        for runner in runners:
+            await runner.cleanup()
+        if config_path is not None:
+            for path in (config_path, config_path + '.cache.json'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_proxy_preserves_repeated_headers(http_session):
+    async def upstream_handler(request):
+        response = web.Response(text='ok')
+        response.headers.add('Set-Cookie', 'a=1')
+        response.headers.add('Set-Cookie', 'b=2')
+        return response
+
+    async with real_load_balancer([upstream_handler]) as lb:
+        async with http_session.get(
+            f'http://localhost:{lb.port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
+            assert resp.headers.getall('Set-Cookie') == ['a=1', 'b=2']
+            assert resp.headers['Access-Control-Allow-Origin'] == '*'
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_proxy_strips_hop_by_hop_headers(http_session):
+    received = []
+
+    async def upstream_handler(request):
+        received.append((request.headers.copy(), await request.read()))
+        return web.Response(text='ok')
+
+    async with real_load_balancer([upstream_handler]) as lb:
+        async with http_session.post(
+            f'http://localhost:{lb.port}/v1/completions',
+            data=b'{"prompt": "Hello"}',
+            headers={
+                'Host': 'client.example',
+                'Connection': 'keep-alive',
+                'Proxy-Authorization': 'Basic c2VjcmV0',
+                'Content-Type': 'application/json',
+                'X-Request-Id': 'abc123',
+            },
+        ) as resp:
+            assert resp.status == 200
+
+        [(headers, body)] = received
+        assert lb.endpoints[0] == f'http://{headers["Host"]}', (
+            'Host should be set from the endpoint URL'
+        )
+        assert 'Connection' not in headers
+        assert 'Proxy-Authorization' not in headers
+        assert headers['Content-Length'] == str(len(body))
+        assert 'Transfer-Encoding' not in headers
+        assert headers['Content-Type'] == 'application/json'
+        assert headers['X-Request-Id'] == 'abc123'
+        assert body == b'{"prompt": "Hello"}'
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_proxy_relays_request_bodies(http_session):
+    received = []
+
+    async def upstream_handler(request):
+        received.append((request.headers.copy(), await request.read()))
+        return web.Response(text='ok')
+
+    # Larger than a single relay chunk
+    payload = os.urandom(200 * 1024)
+
+    async def chunked_payload():
+        for i in range(0, len(payload), 50 * 1024):
+            yield payload[i:i + 50 * 1024]
+
+    async with real_load_balancer([upstream_handler]) as lb:
+        url = f'http://localhost:{lb.port}/v1/files'
+        async with http_session.post(url, data=payload) as resp:
+            assert resp.status == 200
+        async with http_session.post(url, data=chunked_payload()) as resp:
+            assert resp.status == 200
+        async with http_session.get(url) as resp:
+            assert resp.status == 200
+
+    [(sized, sized_body), (chunked, chunked_body), (bodyless, empty)] = (
+        received
+    )
+    assert sized['Content-Length'] == str(len(payload))
+    assert 'Transfer-Encoding' not in sized
+    assert sized_body == payload
+
+    assert chunked['Transfer-Encoding'] == 'chunked'
+    assert 'Content-Length' not in chunked
+    assert chunked_body == payload
+
+    assert 'Transfer-Encoding' not in bodyless, (
+        'Requests without a body should not get a chunked payload'
+    )
+    assert empty == b''
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_least_connections_avoids_busy_endpoint(http_session):
+    arrived = asyncio.Event()
+    release = asyncio.Event()
+
+    def upstream(name):
+        async def handler(request):
+            if request.path == '/v1/hold':
+                arrived.set()
+                await release.wait()
+            return web.Response(text=name)
+
+        return handler
+
+    async def fetch(path):
+        async with http_session.get(f'http://localhost:{lb.port}{path}') as r:
+            assert r.status == 200
+            return await r.text()
+
+    async with real_load_balancer(
+        [upstream('a'), upstream('b')], least_connections=True
+    ) as lb:
+        held = asyncio.ensure_future(fetch('/v1/hold'))
+        try:
+            await asyncio.wait_for(arrived.wait(), timeout=5)
+            assert list(lb._inflight) == [1, 0]
+
+            # Round-robin schedules b and then the busy a again, which must
+            # be swapped for the idle b
+            assert await fetch('/v1/models') == 'b'
+            assert await fetch('/v1/models') == 'b'
+            assert list(lb._inflight) == [1, 0]
+        finally:
+            release.set()
+        assert await held == 'a'
+
+        assert list(lb._inflight) == [0, 0]
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_proxy_endpoint_with_path_prefix(http_session):
+    received = []
+    probes = []
+
+    async def upstream_handler(request):
+        # Like a real backend, anything outside the API is unknown
+        received.append(request.raw_path)
+        if not request.path.startswith('/prefix/v1/'):
+            raise web.HTTPNotFound()
+        return web.Response(text='ok')
+
+    async with real_load_balancer(
+        [upstream_handler],
+        base_path='/prefix/',
+        probes=probes,
+        health_check_interval=0.02,
+    ) as lb:
+        await _wait_for(lambda: len(probes) >= 2)
+        assert probes[0] == '/prefix/health'
+        assert not lb.unhealthy_endpoints
+
+        async with http_session.get(
+            f'http://localhost:{lb.port}/v1/files/a%2Fb?name=x%20y'
+        ) as resp:
+            assert resp.status == 200
+
+    assert received == ['/prefix/v1/files/a%2Fb?name=x%20y']
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_session_recycle(http_session):
+    async def upstream_handler(request):
+        return web.Response(text='ok')
+
+    async with real_load_balancer(
+        [upstream_handler], session_max_age=0.1, upstream_timeout=0.5
+    ) as lb:
+        sessions = [lb.client_session]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 0.45
+        while loop.time() < deadline:
+            if lb.client_session is not sessions[-1]:
+                sessions.append(lb.client_session)
+            await asyncio.sleep(0.01)
+
+        # Swapped every session_max_age, not after each drain as well
+        assert len(sessions) >= 4
+        first = sessions[0]
+        assert not first.closed, 'Retired session should be left to drain'
+        await _wait_for(lambda: first.closed)
+
+        async with http_session.get(
+            f'http://localhost:{lb.port}/v1/models'
+        ) as resp:
+            assert resp.status == 200
+
+    assert all(session.closed for session in sessions)
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_session_recycle_without_upstream_timeout():
+    async def upstream_handler(request):
+        return web.Response(text='ok')
+
+    async with real_load_balancer(
+        [upstream_handler], session_max_age=0.05, upstream_timeout=None
+    ) as lb:
+        first = lb.client_session
+        await _wait_for(lambda: lb.client_session is not first)
+        await asyncio.sleep(0.1)
+        assert not first.closed, 'Retired session should be left to drain'
+        assert not lb._session_recycle_task.done()
+        current = lb.client_session
+
+    assert first.closed, 'Cleanup should close sessions still draining'
+    assert current.closed
+
+
+def test_config_cache():
+    config_path = create_test_config(['http://localhost:2242'])
+    cache_path = config_path + '.cache.json'
+    try:
+        assert load_config(config_path) == {
+            'endpoints': ['http://localhost:2242']
+        }
+        assert os.path.exists(cache_path), 'Parsed config should be cached'
+        assert load_config(config_path) == {
+            'endpoints': ['http://localhost:2242']
+        }
+
+        with open(config_path, 'w') as f:
+            yaml.dump({'endpoints': ['http://localhost:2243']}, f)
+        mtime = os.path.getmtime(cache_path) + 1
+        os.utime(config_path, (mtime, mtime))
+
+        lb = LoadBalancer(config_path)
+        assert lb.endpoints == [
+            'http://localhost:2243'
+        ], 'Stale cache should be ignored after the config changes'
+
+        # Roll back to content with an older mtime, as `cp -p` would
+        assert load_config(config_path) == {
+            'endpoints': ['http://localhost:2243']
+        }
+        with open(config_path, 'w') as f:
+            yaml.dump({'endpoints': ['http://localhost:2244']}, f)
+        mtime -= 3600
+        os.utime(config_path, (mtime, mtime))
+
+        assert load_config(config_path) == {
+            'endpoints': ['http://localhost:2244']
+        }, 'Cache should be ignored when the config is replaced by an older one'
+    finally:
+        for path in (config_path, cache_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_iwrr_interleaves_weights():
+    scheduler = IWRRScheduler([(0, 4), (1, 2), (2, 0)])
+    picks = [scheduler.pick() for _ in range(9)]
+
+    assert picks == [0, 1, 0, 1, 0, 0, 1, 0, 0]
+
+
+def test_smooth_wrr_spreads_weights():
+    scheduler = SmoothWRRScheduler([(0, 5), (1, 1), (2, 1)])
+    picks = [scheduler.pick() for _ in range(14)]
+
+    assert picks == [0, 0, 1, 0, 2, 0, 0] * 2
@@ -2,200 +2,226 @@ import asyncio
 import json
 import statistics
 import time
-from typing import Dict
-from typing import List
+from array import array
+from typing import AsyncIterator
 
-import aiohttp
 import pytest
 import pytest_asyncio
 from aiohttp import web
+from loguru import logger
+from multidict import CIMultiDict
+from multidict import CIMultiDictProxy
+
+from aphrodite_loadbalancer.loadbalancer import _CORS_HEADERS
 
 from .test_loadbalancer import DummyEndpoint
 from .test_loadbalancer import MockLoadBalancer
-from .test_loadbalancer import get_free_port
+
+
+_STREAM_HEADERS = CIMultiDictProxy(
+    CIMultiDict(
+        [*_CORS_HEADERS.items(), ('Content-Type', 'text/event-stream')]
+    )
+)
+# Every streamed chunk has the same payload, so it is serialized only once
+_CANNED_CHUNK = (
+    json.dumps(
+        {
+            'id': 'chatcmpl-123',
+            'object': 'chat.completion.chunk',
+            'choices': [
+                {'delta': {'content': word}}
+                for word in 'This is a test response'.split()
+            ],
+        }
+    ).encode()
+    + b'\n'
+)
+_CANNED_CHUNK_COUNT = 20
+_CANNED_STREAM = _CANNED_CHUNK * _CANNED_CHUNK_COUNT
 
 
 class StreamingDummyEndpoint(DummyEndpoint):
-    def __init__(self, name, latency_ms=0, chunk_delay_ms=0):
+    __slots__ = (
+        'latency_ms',
+        'chunk_delay_ms',
+        'batch_delays',
+        'processing_times',
+    )
+
+    def __init__(
+        self, name, latency_ms=0, chunk_delay_ms=0, batch_delays=True
+    ):
         super().__init__(name)
         self.latency_ms = latency_ms
         self.chunk_delay_ms = chunk_delay_ms
-        self.processing_times: List[float] = []
+        self.batch_delays = batch_delays
+        self.processing_times = array('d')
+
+    async def stream_response(self) -> AsyncIterator[bytes]:
+        """Simulate generating the canned chunks. With `batch_delays` the
+        latency and per-chunk delays are slept in a single timer and the
+        chunks are yielded at once, concatenated; otherwise every chunk is
+        yielded after its own delay."""
+        if self.batch_delays:
+            delay_ms = (
+                self.latency_ms + _CANNED_CHUNK_COUNT * self.chunk_delay_ms
+            )
+            if delay_ms:
+                await asyncio.sleep(delay_ms / 1000)
+            yield _CANNED_STREAM
+            return
 
-    async def stream_response(self, chunks: List[Dict]) -> List[bytes]:
         if self.latency_ms:
             await asyncio.sleep(self.latency_ms / 1000)
-
-        response_chunks = []
-        for chunk in chunks:
+        for _ in range(_CANNED_CHUNK_COUNT):
             if self.chunk_delay_ms:
                 await asyncio.sleep(self.chunk_delay_ms / 1000)
-            response_chunks.append(json.dumps(chunk).encode() + b'\n')
-        return response_chunks
+            yield _CANNED_CHUNK
 
 
 class StreamingMockLoadBalancer(MockLoadBalancer):
-    async def handle_request(self, request: web.Request) -> web.StreamResponse:
-        cors_headers = {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-        }
-
-        if request.method == 'OPTIONS':
-            return web.Response(headers=cors_headers)
-
-        if request.path == '/v1/completions':
-            endpoint_index = next(self.completion_cycle)
-        else:
-            endpoint_index = next(self.general_cycle)
-
+    def _add_routes(self, app: web.Application):
+        # Let aiohttp's router dispatch completions; every other path falls
+        # through to MockLoadBalancer.handle_request
+        app.router.add_post('/v1/completions', self.handle_stream)
+        super()._add_routes(app)
+
+    async def handle_stream(self, request: web.Request) -> web.StreamResponse:
+        endpoint_index = self.completion_cycle.pick()
         endpoint = self.dummy_endpoints[endpoint_index]
         endpoint.request_count += 1
 
-        if request.path == '/v1/completions':
-            start_time = time.perf_counter()
-
-            response = web.StreamResponse(
-                status=200,
-                headers={
-                    **cors_headers,
-                    'Content-Type': 'text/event-stream',
-                },
-            )
-            await response.prepare(request)
-
-            chunks = [
-                {
-                    'id': 'chatcmpl-123',
-                    'object': 'chat.completion.chunk',
-                    'choices': [
-                        {'delta': {'content': word}}
-                        for word in 'This is a test response'.split()
-                    ],
-                }
-                for _ in range(20)
-            ]
+        start_time = time.perf_counter()
 
-            try:
-                for chunk in await endpoint.stream_response(chunks):
-                    await response.write(chunk)
+        response = web.StreamResponse(status=200, headers=_STREAM_HEADERS)
+        await response.prepare(request)
 
-                end_time = time.perf_counter()
-                endpoint.processing_times.append(end_time - start_time)
-                return response
+        try:
+            # Batched endpoints yield the whole stream at once, so it goes
+            # out in a single write
+            async for data in endpoint.stream_response():
+                await response.write(data)
 
-            except Exception as e:
-                print(f'Streaming error: {str(e)}')
-                raise
+            end_time = time.perf_counter()
+            endpoint.processing_times.append(end_time - start_time)
+            return response
 
-        return web.Response(
-            text=f'Response from {endpoint.name}', headers=cors_headers
-        )
+        except Exception:
+            logger.exception('Streaming error')
+            raise
 
 
 @pytest_asyncio.fixture
-async def streaming_load_balancer():
-    port = get_free_port()
+async def streaming_load_balancer(request):
+    # Parametrize indirectly with False to stream every chunk separately
+    batch_delays = getattr(request, 'param', True)
     endpoints = [
-        StreamingDummyEndpoint('fast', latency_ms=10, chunk_delay_ms=5),
-        StreamingDummyEndpoint('slow', latency_ms=50, chunk_delay_ms=10),
+        StreamingDummyEndpoint(
+            'fast', latency_ms=10, chunk_delay_ms=5, batch_delays=batch_delays
+        ),
+        StreamingDummyEndpoint(
+            'slow',
+            latency_ms=50,
+            chunk_delay_ms=10,
+            batch_delays=batch_delays,
+        ),
     ]
     lb = StreamingMockLoadBalancer(endpoints)
-    await lb.start(port)
+    await lb.start(0)
     try:
-        yield lb, endpoints, port
+        yield lb, endpoints, lb.port
     finally:
         await lb.cleanup()
 
 
-@pytest.mark.asyncio
-async def test_streaming_performance(streaming_load_balancer):
+@pytest.mark.asyncio(loop_scope='session')
+async def test_streaming_performance(streaming_load_balancer, http_session):
     lb, endpoints, port = streaming_load_balancer
-    async with aiohttp.ClientSession() as session:
-        num_requests = 50
-        tasks = []
-        for _ in range(num_requests):
-            task = session.post(
-                f'http://localhost:{port}/v1/completions',
-                json={
-                    'model': 'test-model',
-                    'messages': [{'role': 'user', 'content': 'Hello'}],
-                    'stream': True,
-                },
-            )
-            tasks.append(task)
+    num_requests = 50
+    url = f'http://localhost:{port}/v1/completions'
+    body = json.dumps({
+        'model': 'test-model',
+        'messages': [{'role': 'user', 'content': 'Hello'}],
+        'stream': True,
+    }).encode()
+    headers = {'Content-Type': 'application/json'}
+    tasks = [
+        http_session.post(url, data=body, headers=headers)
+        for _ in range(num_requests)
+    ]
 
-        start_time = time.perf_counter()
-        responses = await asyncio.gather(*tasks)
-        end_time = time.perf_counter()
-
-        for resp in responses:
-            assert resp.status == 200
-            async for _ in resp.content:
-                pass
-            await resp.release()
-
-        total_time = end_time - start_time
-        requests_per_second = num_requests / total_time
-
-        for endpoint in endpoints:
-            times = endpoint.processing_times
-            if not times:
-                print(f'\nEndpoint {endpoint.name} had no requests')
-                continue
-
-            stats = {
-                'min': min(times) * 1000,
-                'max': max(times) * 1000,
-                'mean': statistics.mean(times) * 1000,
-                'median': statistics.median(times) * 1000,
-                'stdev': statistics.stdev(times) * 1000
-                if len(times) > 1
-                else 0,
-            }
-            print(f'\nEndpoint {endpoint.name} statistics (ms):')
-            for key, value in stats.items():
-                print(f'{key}: {value:.2f}')
-
-        print('\nOverall performance:')
-        print(f'Total time: {total_time:.2f} seconds')
-        print(f'Requests per second: {requests_per_second:.2f}')
-
-        assert requests_per_second > 10
-        for endpoint in endpoints:
-            if endpoint.processing_times:
-                assert statistics.mean(endpoint.processing_times) < 1.0
-
-
-@pytest.mark.asyncio
-async def test_large_response_overhead(streaming_load_balancer):
+    start_time = time.perf_counter()
+    responses = await asyncio.gather(*tasks)
+    end_time = time.perf_counter()
+
+    for resp in responses:
+        assert resp.status == 200
+        await resp.read()
+
+    total_time = end_time - start_time
+    requests_per_second = num_requests / total_time
+
+    for endpoint in endpoints:
+        times = endpoint.processing_times
+        if not times:
+            print(f'\nEndpoint {endpoint.name} had no requests')
+            continue
+
+        # fmean is a single float pass, and is reused by stdev
+        mean = statistics.fmean(times)
+        stats = {
+            'min': min(times) * 1000,
+            'max': max(times) * 1000,
+            'mean': mean * 1000,
+            'median': statistics.median(times) * 1000,
+            'stdev': statistics.stdev(times, mean) * 1000
+            if len(times) > 1
+            else 0,
+        }
+        print(f'\nEndpoint {endpoint.name} statistics (ms):')
+        for key, value in stats.items():
+            print(f'{key}: {value:.2f}')
+
+    print('\nOverall performance:')
+    print(f'Total time: {total_time:.2f} seconds')
+    print(f'Requests per second: {requests_per_second:.2f}')
+
+    assert requests_per_second > 10
+    for endpoint in endpoints:
+        if endpoint.processing_times:
+            assert statistics.fmean(endpoint.processing_times) < 1.0
+
+
+@pytest.mark.asyncio(loop_scope='session')
+@pytest.mark.parametrize('streaming_load_balancer', [False], indirect=True)
+async def test_large_response_overhead(streaming_load_balancer, http_session):
     lb, endpoints, port = streaming_load_balancer
-    async with aiohttp.ClientSession() as session:
-        large_response = await session.post(
-            f'http://localhost:{port}/v1/completions',
-            json={
-                'model': 'test-model',
-                'messages': [
-                    {'role': 'user', 'content': 'Generate a long response'}
-                ],
-                'max_tokens': 1000,
-                'stream': True,
-            },
-        )
-
-        assert large_response.status == 200
-
-        chunk_times = []
-        start_time = time.perf_counter()
-        async for chunk in large_response.content:
-            chunk_times.append(time.perf_counter() - start_time)
-
-        intervals = [
-            t2 - t1 for t1, t2 in zip(chunk_times[:-1], chunk_times[1:])
-        ]
-        if intervals:
-            print('\nChunk delivery statistics (ms):')
-            print(f'Average interval: {statistics.mean(intervals) * 1000:.2f}')
-            print(f'Max interval: {max(intervals) * 1000:.2f}')
-            assert statistics.mean(intervals) < 0.1
+    large_response = await http_session.post(
+        f'http://localhost:{port}/v1/completions',
+        json={
+            'model': 'test-model',
+            'messages': [
+                {'role': 'user', 'content': 'Generate a long response'}
+            ],
+            'max_tokens': 1000,
+            'stream': True,
+        },
+    )
+
+    assert large_response.status == 200
+
+    chunk_times = []
+    start_time = time.monotonic_ns()
+    async for chunk in large_response.content.iter_any():
+        chunk_times.append(time.monotonic_ns() - start_time)
+
+    assert len(chunk_times) > 1, 'Response should arrive in several chunks'
+    intervals = [
+        (t2 - t1) / 1e9 for t1, t2 in zip(chunk_times, chunk_times[1:])
+    ]
+    mean_interval = statistics.fmean(intervals)
+    print('\nChunk delivery statistics (ms):')
+    print(f'Average interval: {mean_interval * 1000:.2f}')
+    print(f'Max interval: {max(intervals) * 1000:.2f}')
+    assert mean_interval < 0.1